@@ -2,22 +2,63 @@
 # Licensed under the MIT License.
 
 # -*- coding: UTF-8 -*-
+# Note on to_scan mode: LSTM/GRU/RNN are converted to Scan because Nuphar compiles Scan subgraphs.
+# Other execution providers (CPU/CUDA/TensorRT) have optimized kernels for LSTM/GRU/RNN that are faster than Scan,
+# so with --target_ep other than nuphar, those ops are kept as is, with only unused outputs trimmed.
 import argparse
 from enum import Enum
+import hashlib
+import logging
+import mmap
 import numpy as np
 import onnx
+from onnx import external_data_helper
+import os
+import shutil
+import sys
 from .node_factory import NodeFactory, ensure_opset
-from .symbolic_shape_infer import SymbolicShapeInference, get_shape_from_type_proto
+from .symbolic_shape_infer import SymbolicShapeInference, get_opset, get_shape_from_type_proto
+
+logger = logging.getLogger(__name__)
+
+# read-only constants shared by all conversions, to avoid allocating them in the per-node/per-direction loops
+def _readonly(ndarray):
+    ndarray.setflags(write=False)
+    return ndarray
+
+_ONE_I32 = _readonly(np.ones(1, dtype=np.int32))
+_ZERO_SCALAR_I32 = _readonly(np.zeros((), dtype=np.int32))
+_ZERO_SCALAR_F32 = _readonly(np.zeros((), dtype=np.float32))
+
+# protobuf could not serialize a model larger than 2GB, so tensors need to be saved as external data
+_PROTOBUF_SIZE_LIMIT = 2 * 1024 * 1024 * 1024
+
+# execution providers that the output of to_scan mode could target
+_TARGET_EPS = ['nuphar', 'cpu', 'cuda', 'tensorrt']
+
+# cache of symbolic shape inference results, keyed by hash of the model
+_SHAPE_INFER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nuphar_shape_infer')
+
+# options of symbolic shape inference for output models, which are part of the cache key
+_SHAPE_INFER_OPTIONS = {'auto_merge':True}
+
+# canonical op_type of common spellings of activations in LSTM/GRU/RNN attributes
+_ACTIVATIONS = dict([(spelling.encode('utf-8'), act) for act in ['Sigmoid', 'Tanh', 'Relu'] for spelling in [act, act.lower(), act.upper()]])
+
+# map each tensor name to the nodes consuming it
+def build_consumer_index(graph):
+    consumer_index = {}
+    for n in graph.node:
+        for i in n.input:
+            consumer_index.setdefault(i, []).append(n)
+    return consumer_index
 
 # trim outputs of LSTM/GRU/RNN if not used or outputed
-def trim_unused_outputs(node, graph):
+def trim_unused_outputs(node, consumer_index, graph_outputs):
     trimmed = onnx.NodeProto()
     trimmed.CopyFrom(node)
-    graph_outputs = [o.name for o in graph.output]
-    for o_idx in range(len(node.output)):
-        o = node.output[o_idx]
-        use = [n for n in graph.node if o in list(n.input) + graph_outputs]
-        if not use:
+    for o_idx, o in enumerate(node.output):
+        if o not in graph_outputs and o not in consumer_index:
             trimmed.output[o_idx] = ''
     return trimmed
 
@@ -45,7 +86,7 @@ def handle_common_attributes(node, default_activations):
 
     activations = NodeFactory.get_attribute(node, 'activations')
     if activations:
-        activations = [str(x, 'utf-8').lower().capitalize() for x in activations]
+        activations = [_ACTIVATIONS[x] if x in _ACTIVATIONS else str(x, 'utf-8').lower().capitalize() for x in activations]
     else:
         activations = default_activations * num_directions
 
@@ -59,10 +100,18 @@ def handle_common_attributes(node, default_activations):
     return direction, num_directions, activations
 
 # get batch_size, and create batch_node if needed
-def handle_batch_size(X, nf, need_batch_node):
+# static_batch_size overrides symbolic batch_size, so that no batch_node is needed
+def handle_batch_size(X, nf, need_batch_node, static_batch_size=None):
     X_vi = nf.get_value_info(X)
     assert X_vi
     dim = get_shape_from_type_proto(X_vi.type)[1]
+    if type(dim) == str and static_batch_size:
+        # pin the symbolic batch dim in X and graph inputs, so that feeding a different batch size fails
+        for vi in [X_vi] + list(nf.main_graph_.input):
+            for d in vi.type.tensor_type.shape.dim:
+                if d.dim_param == dim:
+                    d.dim_value = static_batch_size
+        dim = static_batch_size
     if type(dim) == str and need_batch_node:
         # only need to create batch_node for symbolic batch_size
         # otherwise, just use numpy.zeros
@@ -72,15 +121,48 @@ def handle_batch_size(X, nf, need_batch_node):
         node = None
     return dim, node
 
+# flatten X [seq_len, batch_size, input_size] to 2D for Gemm
+# also returns the [seq_len, batch_size] part of shape to restore the projection to 3D
+def flatten_input_for_gemm(X, nf, batch_size, input_size):
+    X_2d = nf.make_node('Reshape', [X, np.asarray([-1, input_size]).astype(np.int64)])
+    if type(batch_size) == int:
+        seq_batch_shape = np.asarray([-1, batch_size]).astype(np.int64)
+    else:
+        seq_batch_shape = nf.make_node('Slice', nf.make_node('Shape', X), {'axes':[0],'starts':[0],'ends':[2]})
+    return X_2d, seq_batch_shape
+
+# input projection X*W_t + B with a single Gemm on flattened X, reshaped back to [seq_len, batch_size, proj_size]
+# W_ts/Bs are indexed by direction, and bidirectional weights are concatenated to share one Gemm, then split per direction
+# returns names of the projection for each direction
+def make_input_projection(X_2d, seq_batch_shape, W_ts, Bs, nf):
+    num_directions = len(W_ts)
+    proj_size = W_ts[0].shape[1]
+    W_t = np.concatenate(W_ts, axis=1) if num_directions > 1 else W_ts[0]
+    B = np.concatenate(Bs) if num_directions > 1 else Bs[0]
+    X_proj_2d = nf.make_node('Gemm', [X_2d, W_t, B], {'alpha':1.0, 'beta':1.0, 'transB':0})
+    if type(seq_batch_shape) == np.ndarray:
+        proj_shape = np.concatenate((seq_batch_shape, np.asarray([num_directions*proj_size]).astype(np.int64)))
+    else:
+        proj_shape = nf.make_node('Concat', [seq_batch_shape, np.asarray([num_directions*proj_size]).astype(np.int64)], {'axis':0})
+    X_proj = nf.make_node('Reshape', [X_proj_2d, proj_shape])
+    if num_directions == 1:
+        return [X_proj.name]
+    split_names = [X_proj.name + '_split_' + str(i) for i in range(num_directions)]
+    nf.make_node('Split', X_proj, {'axis':2, 'split':[proj_size]*num_directions}, output_names=split_names)
+    return split_names
+
 # create default init state with zeros
-def default_init_state(X, batch_size, batch_node, hidden_size, nf, postfix=''):
+# the zero state is named by X and hidden_size, so that LSTM/GRU/RNN reading the same X share it when hidden sizes match
+def default_init_state(X, batch_size, batch_node, hidden_size, nf):
     if batch_node:
         shape = nf.make_node('Concat', [batch_node, np.asarray([hidden_size]).astype(np.int64)], {'axis':0})
         return nf.make_node('ConstantOfShape', shape)
     else:
         assert type(batch_size) == int
         # add default init state to graph input
-        initializer_name = X + '_zero_init_state' + postfix
+        initializer_name = X + '_zero_init_state_' + str(hidden_size)
+        if nf.get_initializer(initializer_name) is not None:
+            return initializer_name
         initializer_shape = (batch_size, hidden_size)
         nf.make_value_info(initializer_name, onnx.TensorProto.FLOAT, initializer_shape, NodeFactory.ValueInfoType.input)
         return nf.make_initializer(np.zeros(initializer_shape, dtype=np.float32), initializer_name)
@@ -98,11 +180,19 @@ def declare_seq_len_in_subgraph(seq_len, nf_body, prefix, batch_size):
         seq_len_subgraph = None
     return seq_len_subgraph
 
+# declare float value infos of shape [batch_size, dim] in subgraph
+def declare_float_value_infos(nf_body, names, batch_size, dim, usage=None):
+    for name in names:
+        nf_body.make_value_info(name,
+                                data_type=onnx.TensorProto.FLOAT,
+                                shape=(batch_size, dim),
+                                usage=usage)
+
 # hook subgraph outputs, with condition from seq_len_subgraph
 def handle_subgraph_outputs(nf_body, seq_len_subgraph, batch_size, hidden_size, subgraph_output_or_default):
     final_subgraph_output = []
     if seq_len_subgraph:
-        seq_len_output = nf_body.make_node('Sub', [seq_len_subgraph, np.asarray([1]).astype(np.int32)])
+        seq_len_output = nf_body.make_node('Sub', [seq_len_subgraph, _ONE_I32])
         nf_body.make_value_info(seq_len_output,
                                 data_type=onnx.TensorProto.INT32,
                                 shape=(batch_size,),
@@ -110,7 +200,7 @@ def handle_subgraph_outputs(nf_body, seq_len_subgraph, batch_size, hidden_size,
         final_subgraph_output.append(seq_len_output)
 
         # since seq_len is rank-1, need to unsqueeze for Where op on rank-2 states
-        condition = nf_body.make_node('Unsqueeze', nf_body.make_node('Greater', [seq_len_subgraph, np.zeros(shape=(), dtype=np.int32)]), {'axes':[1]})
+        condition = nf_body.make_node('Unsqueeze', nf_body.make_node('Greater', [seq_len_subgraph, _ZERO_SCALAR_I32]), {'axes':[1]})
         for valid, default in subgraph_output_or_default:
             final_subgraph_output.append(nf_body.make_node('Where', [condition, valid, default]))
     else:
@@ -126,6 +216,76 @@ def handle_subgraph_outputs(nf_body, seq_len_subgraph, batch_size, hidden_size,
 
     return final_subgraph_output
 
+# create Scan ops of LSTM/GRU/RNN, with cell built in scan body by make_cell(nf_body, direction_index, name_prefix, prev_states, X_proj_subgraph)
+# make_cell returns new states, with hidden state first
+# init_states/X_projs/is_backwards are indexed by direction, where init_states are like [init_h, init_c] for LSTM
+# returns names of scan outputs, and of final states in the same layout as state_outputs of handle_final_scan_outputs
+# for bidirectional without seq_len, both directions share one Scan with scan inputs in opposite directions, to halve the overhead of running Scan
+# the shared scan body has independent cells for each direction, which could run in parallel
+def make_scans(node, nf, out_main_graph, main_initializers, seq_len, batch_size, hidden_size, proj_size, X_projs, init_states, is_backwards, make_cell):
+    num_directions = len(X_projs)
+    num_states = len(init_states[0])
+    state_postfixes = ['_h_subgraph', '_c_subgraph'][:num_states]
+    # seq_len is applied per batch in each direction, so directions could only share one Scan without it
+    if num_directions == 2 and not seq_len:
+        scan_groups = [[0, 1]]
+    else:
+        scan_groups = [[direction_index] for direction_index in range(num_directions)]
+
+    scan_outputs = [None] * num_directions
+    state_outputs = [[None] * num_directions for i in range(num_states)]
+    for directions in scan_groups:
+        name_prefix = node.output[0] + '_' + '_'.join([str(d) for d in directions]) + '_'
+        direction_prefixes = dict([(d, node.output[0] + '_' + str(d) + '_') for d in directions])
+
+        scan_body = onnx.GraphProto()
+        scan_body.name = name_prefix + '_subgraph'
+
+        nf_body = NodeFactory(out_main_graph, scan_body, main_initializers=main_initializers)
+        with nf_body.scoped_prefix(name_prefix) as body_scoped_prefix:
+            # subgraph inputs, with states of all directions before scan inputs
+            seq_len_subgraph = declare_seq_len_in_subgraph(seq_len, nf_body, X_projs[directions[0]], batch_size)
+            prev_states = dict([(d, [direction_prefixes[d] + p for p in state_postfixes]) for d in directions])
+            for d in directions:
+                declare_float_value_infos(nf_body, prev_states[d], batch_size, hidden_size, NodeFactory.ValueInfoType.input)
+            declare_float_value_infos(nf_body, [X_projs[d] + '_subgraph' for d in directions], batch_size, proj_size, NodeFactory.ValueInfoType.input)
+
+            # subgraph nodes
+            subgraph_output_or_default = []
+            new_hs = []
+            for d in directions:
+                with nf_body.scoped_prefix(direction_prefixes[d]):
+                    new_states = make_cell(nf_body, d, direction_prefixes[d], prev_states[d], X_projs[d] + '_subgraph')
+                subgraph_output_or_default += list(zip(new_states, prev_states[d]))
+                new_hs.append(new_states[0])
+            if node.output[0]: # skip scan output if node.output[0] is empty
+                subgraph_output_or_default += [(h, _ZERO_SCALAR_F32) for h in new_hs]
+
+            subgraph_outputs = handle_subgraph_outputs(nf_body,
+                                                       seq_len_subgraph,
+                                                       batch_size,
+                                                       hidden_size,
+                                                       subgraph_output_or_default)
+
+            scan_attribs = {'body':scan_body,
+                            'scan_input_directions':[is_backwards[d] for d in directions],
+                            'num_scan_inputs':len(directions)}
+            if node.output[0]:
+                scan_attribs.update({'scan_output_directions':[is_backwards[d] for d in directions]})
+            # names of scan outputs besides seq_len, which are the same as subgraph outputs
+            scan_output_names = [o.name for o in subgraph_outputs[1:]]
+            nf.make_node('Scan', ([seq_len] if seq_len else []) + [s for d in directions for s in init_states[d]] + [X_projs[d] for d in directions],
+                         scan_attribs,
+                         output_names=([subgraph_outputs[0].name] if seq_len else []) + scan_output_names)
+
+            for i_d, d in enumerate(directions):
+                for i_s in range(num_states):
+                    state_outputs[i_s][d] = scan_output_names[i_d*num_states + i_s]
+                if node.output[0]:
+                    scan_outputs[d] = scan_output_names[len(directions)*num_states + i_d]
+
+    return scan_outputs, state_outputs
+
 # unsqueeze/concat for the final outputs from scans, when the LSTM/GRU/RNN node is bidirectional
 def handle_final_scan_outputs(node, nf, scan_outputs, state_outputs, num_directions):
     if num_directions == 2:
@@ -143,9 +303,9 @@ def handle_final_scan_outputs(node, nf, scan_outputs, state_outputs, num_directi
         for i_o in range(1, len(node.output)):
             nf.make_node('Unsqueeze', state_outputs[i_o - 1], {'axes':[0]}, output_names=node.output[i_o])
 
-def convert_lstm_to_scan(node, out_main_graph):
+def convert_lstm_to_scan(node, out_main_graph, main_initializers=None, static_batch_size=None):
     assert node.op_type == 'LSTM'
-    nf = NodeFactory(out_main_graph)
+    nf = NodeFactory(out_main_graph, main_initializers=main_initializers)
     with nf.scoped_prefix(node.output[0]) as scoped_prefix:
         X = node.input[0]
         Wa = nf.get_initializer(node.input[1])
@@ -176,12 +336,24 @@ def convert_lstm_to_scan(node, out_main_graph):
         else:
             InitCa = handle_init_state(InitCa, nf, num_directions)
 
-        batch_size, batch_node = handle_batch_size(X, nf, InitHa is None or InitCa is None)
-
-        scan_outputs = []
-        scan_h_outputs = []
-        scan_c_outputs = []
-        for direction_index in range(num_directions):
+        batch_size, batch_node = handle_batch_size(X, nf, InitHa is None or InitCa is None, static_batch_size)
+        if InitHa is None or InitCa is None:
+            # default init states of h and c are the same zeros, so share them between h/c and directions
+            zero_init_state = default_init_state(X, batch_size, batch_node, hidden_size, nf)
+        input_size = Wa.shape[len(Wa.shape) - 1]
+        X_2d, seq_batch_shape = flatten_input_for_gemm(X, nf, batch_size, input_size)
+        # transpose weights and sum biases for all directions at once
+        W_ts = np.ascontiguousarray(np.transpose(Wa, (0, 2, 1)), dtype=np.float32) # [num_directions, input_size, 4*hidden_size]
+        R_ts = np.ascontiguousarray(np.transpose(Ra, (0, 2, 1)), dtype=np.float32) # [num_directions, hidden_size, 4*hidden_size]
+        Bs = Ba.reshape(num_directions, 2, 4*hidden_size).sum(axis=1, dtype=np.float32) # [num_directions, 4*hidden_size]
+        X_projs = make_input_projection(X_2d, seq_batch_shape, W_ts, Bs, nf) # [seq_len, batch_size, 4*hidden_size] for each direction
+
+        act_groups = [tuple(activations[i*3:(i+1)*3]) for i in range(num_directions)] # activations for each direction
+        is_backwards = [0, 1] if num_directions == 2 else [0 if direction == 'forward' else 1]
+        init_states = [[zero_init_state if InitHa is None else InitHa[direction_index],
+                        zero_init_state if InitCa is None else InitCa[direction_index]] for direction_index in range(num_directions)]
+
+        def make_cell(nf_body, direction_index, name_prefix, prev_states, X_proj_subgraph):
             # for each direction
             # X [seq_len, batch_size, input_size]
             # W [4*hidden_size, input_size]
@@ -191,101 +363,39 @@ def convert_lstm_to_scan(node, out_main_graph):
             # init_h [batch_size, hidden_size]
             # init_c [batch_size, hidden_size]
             # PB [3*hidden_size]
-
-            name_prefix = node.output[0] + '_' + str(direction_index) + '_'
-
-            if InitHa is None:
-                init_h = default_init_state(X, batch_size, batch_node, hidden_size, nf, '_H')
-            else:
-                init_h = InitHa[direction_index]
-
-            if InitCa is None:
-                init_c =  default_init_state(X, batch_size, batch_node, hidden_size, nf, '_C')
-            else:
-                init_c = InitCa[direction_index]
-
-            input_size = Wa.shape[len(Wa.shape) - 1]
-            Wt = np.transpose(Wa[direction_index])
-            Rt = np.transpose(Ra[direction_index])
-            B = Ba[direction_index].reshape(2, 4*hidden_size).sum(axis=0) # [4*hidden_size]
-            X_proj = nf.make_node('MatMul', [X, Wt]) #[seq_len, batch_size, 4*hidden_size]
-            X_proj = nf.make_node('Add', [X_proj, B])
-            if num_directions == 1:
-                is_backward = 0 if direction == 'forward' else 1
-            else:
-                is_backward = direction_index
-
-            scan_body = onnx.GraphProto()
-            scan_body.name = name_prefix + '_subgraph'
-
-            nf_body = NodeFactory(out_main_graph, scan_body)
-            with nf_body.scoped_prefix(name_prefix) as body_scoped_prefix:
-                # subgraph inputs
-                X_proj_subgraph = X_proj.name + '_subgraph'
-                prev_h_subgraph = name_prefix + '_h_subgraph'
-                prev_c_subgraph = name_prefix + '_c_subgraph'
-
-                seq_len_subgraph = declare_seq_len_in_subgraph(seq_len, nf_body, X_proj.name, batch_size)
-
-                for subgraph_i in [prev_h_subgraph, prev_c_subgraph]:
-                    nf_body.make_value_info(subgraph_i,
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size),
-                                            usage=NodeFactory.ValueInfoType.input)
-
-                nf_body.make_value_info(X_proj_subgraph,
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, 4*hidden_size),
-                                        usage=NodeFactory.ValueInfoType.input)
-                # subgraph nodes
-                # it = f(Xt*(Wi^T) + Ht-1*(Ri^T) + Pi (.) Ct-1 + Wbi + Rbi)
-                # ft = f(Xt*(Wf^T) + Ht-1*(Rf^T) + Pf (.) Ct-1 + Wbf + Rbf)
-                # ct = g(Xt*(Wc^T) + Ht-1*(Rc^T) + Wbc + Rbc)
-                # Ct = ft (.) Ct-1 + it (.) ct
-                # ot = f(Xt*(Wo^T) + Ht-1*(Ro^T) + Po (.) Ct + Wbo + Rbo)
-                # Ht = ot (.) h(Ct)
-                prev_h_proj = nf_body.make_node('MatMul', [prev_h_subgraph, Rt])
-                sum_x_proj_h_proj_bias = nf_body.make_node('Add', [X_proj_subgraph, prev_h_proj])
-                split_outputs = ['split_i', 'split_o', 'split_f', 'split_c']
-                nf_body.make_node('Split', sum_x_proj_h_proj_bias, {"axis":1, "split":[hidden_size]*4}, output_names=split_outputs)
-                # manually add shape inference to split outputs
-                for split_o in split_outputs:
-                    nf_body.make_value_info(split_o,
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size))
-                activation_f, activation_g, activation_h = activations[direction_index*3:(direction_index+1)*3]
-                it = nf_body.make_node(activation_f, 'split_i')
-                ft = nf_body.make_node(activation_f, 'split_f')
-                ct = nf_body.make_node(activation_g, 'split_c')
-                c_subgraph = nf_body.make_node('Add',
-                                               [nf_body.make_node('Mul', [ft, prev_c_subgraph]),
-                                                nf_body.make_node('Mul', [it, ct])])
-                ot = nf_body.make_node(activation_f, 'split_o')
-                h_subgraph = nf_body.make_node('Mul', [ot, nf_body.make_node(activation_h, c_subgraph)])
-
-                subgraph_outputs = handle_subgraph_outputs(nf_body,
-                                                           seq_len_subgraph,
-                                                           batch_size,
-                                                           hidden_size,
-                                                           [(h_subgraph, prev_h_subgraph),
-                                                            (c_subgraph, prev_c_subgraph)] +
-                                                           ([(h_subgraph, np.zeros(shape=(), dtype=np.float32))] if node.output[0] else [])) # skip scan output if node.output[0] is empty
-
-                scan_attribs = {'body':scan_body,
-                                'scan_input_directions':[is_backward],
-                                'num_scan_inputs':1}
-                if node.output[0]:
-                    scan_attribs.update({'scan_output_directions':[is_backward]})
-                scan = nf.make_node('Scan', ([seq_len] if seq_len else []) + [init_h, init_c, X_proj],
-                                    scan_attribs,
-                                    output_names=[o.name for o in subgraph_outputs[(0 if seq_len else 1):]])
-
-                scan_h_outputs.append(subgraph_outputs[1])
-                scan_c_outputs.append(subgraph_outputs[2])
-                if node.output[0]:
-                    scan_outputs.append(subgraph_outputs[3])
-
-        handle_final_scan_outputs(node, nf, scan_outputs, [scan_h_outputs, scan_c_outputs], num_directions)
+            prev_h_subgraph, prev_c_subgraph = prev_states
+            Rt = R_ts[direction_index]
+
+            # subgraph nodes
+            # it = f(Xt*(Wi^T) + Ht-1*(Ri^T) + Pi (.) Ct-1 + Wbi + Rbi)
+            # ft = f(Xt*(Wf^T) + Ht-1*(Rf^T) + Pf (.) Ct-1 + Wbf + Rbf)
+            # ct = g(Xt*(Wc^T) + Ht-1*(Rc^T) + Wbc + Rbc)
+            # Ct = ft (.) Ct-1 + it (.) ct
+            # ot = f(Xt*(Wo^T) + Ht-1*(Ro^T) + Po (.) Ct + Wbo + Rbo)
+            # Ht = ot (.) h(Ct)
+            prev_h_proj = nf_body.make_node('MatMul', [prev_h_subgraph, Rt])
+            sum_x_proj_h_proj_bias = nf_body.make_node('Add', [X_proj_subgraph, prev_h_proj])
+            split_iof, split_c = [name_prefix + 'split_iof', name_prefix + 'split_c']
+            nf_body.make_node('Split', sum_x_proj_h_proj_bias, {"axis":1, "split":[3*hidden_size, hidden_size]}, output_names=[split_iof, split_c])
+            # manually add shape inference to split outputs
+            declare_float_value_infos(nf_body, [split_iof], batch_size, 3*hidden_size)
+            declare_float_value_infos(nf_body, [split_c], batch_size, hidden_size)
+            activation_f, activation_g, activation_h = act_groups[direction_index]
+            # gates i/o/f are contiguous and share activation_f, so activate them with one op before splitting
+            iot_ft = nf_body.make_node(activation_f, split_iof)
+            it, ot, ft = [name_prefix + 'split_it', name_prefix + 'split_ot', name_prefix + 'split_ft']
+            nf_body.make_node('Split', iot_ft, {"axis":1, "split":[hidden_size]*3}, output_names=[it, ot, ft])
+            declare_float_value_infos(nf_body, [it, ot, ft], batch_size, hidden_size)
+            ct = nf_body.make_node(activation_g, split_c)
+            c_subgraph = nf_body.make_node('Add',
+                                           [nf_body.make_node('Mul', [ft, prev_c_subgraph]),
+                                            nf_body.make_node('Mul', [it, ct])])
+            h_subgraph = nf_body.make_node('Mul', [ot, nf_body.make_node(activation_h, c_subgraph)])
+            return [h_subgraph, c_subgraph]
+
+        scan_outputs, state_outputs = make_scans(node, nf, out_main_graph, main_initializers, seq_len, batch_size, hidden_size, 4*hidden_size,
+                                                 X_projs, init_states, is_backwards, make_cell)
+        handle_final_scan_outputs(node, nf, scan_outputs, state_outputs, num_directions)
 
     # remove old initializers
     nf.remove_initializer(node.input[1])
@@ -298,9 +408,9 @@ def convert_lstm_to_scan(node, out_main_graph):
         nf.remove_initializer(node.input[6], allow_empty=True)
     return True
 
-def convert_gru_to_scan(node, out_main_graph):
+def convert_gru_to_scan(node, out_main_graph, main_initializers=None, static_batch_size=None):
     assert node.op_type == 'GRU'
-    nf = NodeFactory(out_main_graph)
+    nf = NodeFactory(out_main_graph, main_initializers=main_initializers)
     with nf.scoped_prefix(node.output[0]) as scoped_prefix:
         X = node.input[0]
         Wa = nf.get_initializer(node.input[1])
@@ -316,13 +426,26 @@ def convert_gru_to_scan(node, out_main_graph):
         linear_before_reset = NodeFactory.get_attribute(node, 'linear_before_reset')
         InitHa = handle_init_state(InitHa, nf, num_directions)
 
-        batch_size, batch_node = handle_batch_size(X, nf, InitHa is None)
+        batch_size, batch_node = handle_batch_size(X, nf, InitHa is None, static_batch_size)
         if InitHa is None:
             zero_init_state = default_init_state(X, batch_size, batch_node, hidden_size, nf)
 
-        scan_outputs = []
-        scan_h_outputs = []
-        for direction_index in range(num_directions):
+        input_size = Wa.shape[len(Wa.shape) - 1]
+        X_2d, seq_batch_shape = flatten_input_for_gemm(X, nf, batch_size, input_size)
+        # transpose weights and sum biases for all directions at once
+        W_ts = np.ascontiguousarray(np.transpose(Wa, (0, 2, 1)), dtype=np.float32) # [num_directions, input_size, 3*hidden_size]
+        R_ts = np.ascontiguousarray(np.transpose(Ra, (0, 2, 1)), dtype=np.float32) # [num_directions, hidden_size, 3*hidden_size]
+        Bs = Ba.reshape(num_directions, 2, 3*hidden_size).astype(np.float32)
+        X_proj_Bs = np.concatenate((Bs[:, :, :2*hidden_size].sum(axis=1), Bs[:, 0, 2*hidden_size:]), axis=1) # [Wbz + Rbz, Wbr + Rbr, Wbh] for each direction
+        if linear_before_reset:
+            H_proj_Bs = np.concatenate((np.zeros((num_directions, 2*hidden_size), dtype=np.float32), Bs[:, 1, 2*hidden_size:]), axis=1) # [0, 0, Rbh] for each direction
+        X_projs = make_input_projection(X_2d, seq_batch_shape, W_ts, X_proj_Bs, nf) # [seq_len, batch_size, 3*hidden_size] for each direction
+
+        act_groups = [tuple(activations[i*2:(i+1)*2]) for i in range(num_directions)] # activations for each direction
+        is_backwards = [0, 1] if num_directions == 2 else [0 if direction == 'forward' else 1]
+        init_states = [[zero_init_state if InitHa is None else InitHa[direction_index]] for direction_index in range(num_directions)]
+
+        def make_cell(nf_body, direction_index, name_prefix, prev_states, X_proj_subgraph):
             # for each direction
             # X [seq_len, batch_size, input_size]
             # W [3*hidden_size, input_size]
@@ -330,125 +453,47 @@ def convert_gru_to_scan(node, out_main_graph):
             # B [6*hidden_size]
             # seq_len [batch_size]
             # init_h [batch_size, hidden_size]
-
-            name_prefix = node.output[0] + '_' + str(direction_index) + '_'
-
-            if InitHa is None:
-                init_h = zero_init_state
-            else:
-                init_h = InitHa[direction_index]
-
-            input_size = Wa.shape[len(Wa.shape) - 1]
-            W_t = np.transpose(Wa[direction_index]) # [input_size, 3*hidden_size]
-            R_t = np.transpose(Ra[direction_index]) # [hidden_size, 3*hidden_size]
-            Rzr_t, Rh_t = np.hsplit(R_t, [2*hidden_size]) # [hidden_size, 2*hidden_size] and [hidden_size, hidden_size]
-            Bzr, Bh = np.hsplit(Ba[direction_index].reshape(2, 3*hidden_size), [2*hidden_size])
-            Bzr = Bzr.sum(axis=0) # [2*hidden_size]
-            Wbh = Bh[0]
-            Rbh = Bh[1]
-            X_proj = nf.make_node('Add', [nf.make_node('MatMul', [X, W_t]), np.concatenate((Bzr, Wbh))]) #[seq_len, batch_size, 3*hidden_size]
-            if num_directions == 1:
-                is_backward = 0 if direction == 'forward' else 1
+            prev_h_subgraph, = prev_states
+            R_t = R_ts[direction_index] # [hidden_size, 3*hidden_size]
+            Rzr_t, Rh_t = [np.ascontiguousarray(r) for r in np.hsplit(R_t, [2*hidden_size])] # [hidden_size, 2*hidden_size] and [hidden_size, hidden_size]
+
+            # subgraph nodes
+            # zt = f(Xt*(Wz^T) + Ht-1*(Rz^T) + Wbz + Rbz)
+            # rt = f(Xt*(Wr^T) + Ht-1*(Rr^T) + Wbr + Rbr)
+            # ht = g(Xt*(Wh^T) + (rt (.) Ht-1)*(Rh^T) + Rbh + Wbh) # default, when linear_before_reset = 0
+            # ht = g(Xt*(Wh^T) + (rt (.) (Ht-1*(Rh^T) + Rbh)) + Wbh) # when linear_before_reset != 0
+            # Ht = (1 - zt) (.) ht + zt (.) Ht-1
+
+            split_Xzr, split_Xh = [name_prefix + 'split_Xzr', name_prefix + 'split_Xh']
+            nf_body.make_node('Split', X_proj_subgraph, {"axis":1, "split":[2*hidden_size, hidden_size]}, output_names=[split_Xzr, split_Xh])
+            declare_float_value_infos(nf_body, [split_Xzr], batch_size, 2*hidden_size)
+            declare_float_value_infos(nf_body, [split_Xh], batch_size, hidden_size)
+
+            activation_f, activation_g = act_groups[direction_index]
+            split_zt, split_rt = [name_prefix + 'split_zt', name_prefix + 'split_rt']
+
+            if linear_before_reset:
+                prev_h_proj = nf_body.make_node('Add', [nf_body.make_node('MatMul', [prev_h_subgraph, R_t]), H_proj_Bs[direction_index]])
+                split_Hzr, split_Hh = [name_prefix + 'split_Hzr', name_prefix + 'split_Hh']
+                nf_body.make_node('Split', prev_h_proj, {"axis":1, "split":[2*hidden_size, hidden_size]}, output_names=[split_Hzr, split_Hh])
+                ztrt = nf_body.make_node(activation_f, nf_body.make_node('Add', [split_Hzr, split_Xzr]))
+                nf_body.make_node('Split', ztrt, {"axis":1, "split":[hidden_size, hidden_size]}, output_names=[split_zt, split_rt])
+                declare_float_value_infos(nf_body, [split_Hzr], batch_size, 2*hidden_size)
+                declare_float_value_infos(nf_body, [split_Hh, split_zt, split_rt], batch_size, hidden_size)
+                ht = nf_body.make_node(activation_g, nf_body.make_node('Add', [nf_body.make_node('Mul', [split_rt, split_Hh]), split_Xh]))
             else:
-                is_backward = direction_index
-
-            scan_body = onnx.GraphProto()
-            scan_body.name = name_prefix + '_subgraph'
-
-            nf_body = NodeFactory(out_main_graph, scan_body)
-            with nf_body.scoped_prefix(name_prefix) as body_scoped_prefix:
-                # subgraph inputs
-                X_proj_subgraph = X_proj.name + '_subgraph'
-                prev_h_subgraph = name_prefix + '_h_subgraph'
-
-                seq_len_subgraph = declare_seq_len_in_subgraph(seq_len, nf_body, X_proj.name, batch_size)
-
-                nf_body.make_value_info(prev_h_subgraph,
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, hidden_size),
-                                        usage=NodeFactory.ValueInfoType.input)
-
-                nf_body.make_value_info(X_proj_subgraph,
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, 3*hidden_size),
-                                        usage=NodeFactory.ValueInfoType.input)
-
-                # subgraph nodes
-                # zt = f(Xt*(Wz^T) + Ht-1*(Rz^T) + Wbz + Rbz)
-                # rt = f(Xt*(Wr^T) + Ht-1*(Rr^T) + Wbr + Rbr)
-                # ht = g(Xt*(Wh^T) + (rt (.) Ht-1)*(Rh^T) + Rbh + Wbh) # default, when linear_before_reset = 0
-                # ht = g(Xt*(Wh^T) + (rt (.) (Ht-1*(Rh^T) + Rbh)) + Wbh) # when linear_before_reset != 0
-                # Ht = (1 - zt) (.) ht + zt (.) Ht-1
-
-                split_X_outputs = ['split_Xzr', 'split_Xh']
-                nf_body.make_node('Split', X_proj_subgraph, {"axis":1, "split":[2*hidden_size, hidden_size]}, output_names=split_X_outputs)
-                nf_body.make_value_info('split_Xzr',
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, 2*hidden_size))
-                nf_body.make_value_info('split_Xh',
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, hidden_size))
-
-                activation_f, activation_g = activations[direction_index*2:(direction_index+1)*2]
-
-                if linear_before_reset:
-                    prev_h_proj = nf_body.make_node('Add', [nf_body.make_node('MatMul', [prev_h_subgraph, R_t]), np.concatenate((np.zeros(2*hidden_size).astype(np.float32), Rbh))])
-                    split_prev_h_outputs = ['split_Hzr', 'split_Hh']
-                    nf_body.make_node('Split', prev_h_proj, {"axis":1, "split":[2*hidden_size, hidden_size]}, output_names=split_prev_h_outputs)
-                    nf_body.make_value_info('split_Hzr',
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, 2*hidden_size))
-                    nf_body.make_value_info('split_Hh',
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size))
-                    ztrt = nf_body.make_node(activation_f, nf_body.make_node('Add', ['split_Hzr', 'split_Xzr']))
-                    split_ztrt_outputs = ['split_zt', 'split_rt']
-                    nf_body.make_node('Split', ztrt, {"axis":1, "split":[hidden_size, hidden_size]}, output_names=split_ztrt_outputs)
-                    nf_body.make_value_info('split_zt',
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size))
-                    nf_body.make_value_info('split_rt',
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size))
-                    ht = nf_body.make_node(activation_g, nf_body.make_node('Add', [nf_body.make_node('Mul', ['split_rt', 'split_Hh']), 'split_Xh']))
-                else:
-                    ztrt = nf_body.make_node(activation_f, nf_body.make_node('Add', [nf_body.make_node('MatMul', [prev_h_subgraph, Rzr_t]), 'split_Xzr']))
-                    split_ztrt_outputs = ['split_zt', 'split_rt']
-                    nf_body.make_node('Split', ztrt, {"axis":1, "split":[hidden_size, hidden_size]}, output_names=split_ztrt_outputs)
-                    nf_body.make_value_info('split_zt',
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size))
-                    nf_body.make_value_info('split_rt',
-                                            data_type=onnx.TensorProto.FLOAT,
-                                            shape=(batch_size, hidden_size))
-                    ht = nf_body.make_node(activation_g, nf_body.make_node('Add', [nf_body.make_node('MatMul', [nf_body.make_node('Mul', [prev_h_subgraph, 'split_rt']), Rh_t]), 'split_Xh']))
-
-                Ht = nf_body.make_node('Add', [nf_body.make_node('Mul', [nf_body.make_node('Sub', [np.asarray([1]).astype(np.float32),
-                                                                                                   'split_zt']),
-                                                                         ht]),
-                                               nf_body.make_node('Mul', ['split_zt', prev_h_subgraph])])
-
-                subgraph_outputs = handle_subgraph_outputs(nf_body,
-                                                           seq_len_subgraph,
-                                                           batch_size,
-                                                           hidden_size,
-                                                           [(Ht, prev_h_subgraph)] +
-                                                           ([(Ht, np.zeros(shape=(), dtype=np.float32))] if node.output[0] else []))
-
-                scan_attribs = {'body':scan_body,
-                                'scan_input_directions':[is_backward],
-                                'num_scan_inputs':1}
-                if node.output[0]:
-                    scan_attribs.update({'scan_output_directions':[is_backward]})
-                scan = nf.make_node('Scan', ([seq_len] if seq_len else []) + [init_h, X_proj],
-                                    scan_attribs,
-                                    output_names=[o.name for o in subgraph_outputs[(0 if seq_len else 1):]])
+                ztrt = nf_body.make_node(activation_f, nf_body.make_node('Add', [nf_body.make_node('MatMul', [prev_h_subgraph, Rzr_t]), split_Xzr]))
+                nf_body.make_node('Split', ztrt, {"axis":1, "split":[hidden_size, hidden_size]}, output_names=[split_zt, split_rt])
+                declare_float_value_infos(nf_body, [split_zt, split_rt], batch_size, hidden_size)
+                ht = nf_body.make_node(activation_g, nf_body.make_node('Add', [nf_body.make_node('MatMul', [nf_body.make_node('Mul', [prev_h_subgraph, split_rt]), Rh_t]), split_Xh]))
 
-                scan_h_outputs.append(subgraph_outputs[1])
-                if node.output[0]:
-                    scan_outputs.append(subgraph_outputs[2])
+            # compute Ht as zt (.) (Ht-1 - ht) + ht, which needs one less Mul and no (1 - zt)
+            Ht = nf_body.make_node('Add', [nf_body.make_node('Mul', [split_zt, nf_body.make_node('Sub', [prev_h_subgraph, ht])]), ht])
+            return [Ht]
 
-        handle_final_scan_outputs(node, nf, scan_outputs, [scan_h_outputs], num_directions)
+        scan_outputs, state_outputs = make_scans(node, nf, out_main_graph, main_initializers, seq_len, batch_size, hidden_size, 3*hidden_size,
+                                                 X_projs, init_states, is_backwards, make_cell)
+        handle_final_scan_outputs(node, nf, scan_outputs, state_outputs, num_directions)
 
     # remove old initializers
     nf.remove_initializer(node.input[1])
@@ -459,9 +504,9 @@ def convert_gru_to_scan(node, out_main_graph):
         nf.remove_initializer(node.input[5], allow_empty=True)
     return True
 
-def convert_rnn_to_scan(node, out_main_graph):
+def convert_rnn_to_scan(node, out_main_graph, main_initializers=None, static_batch_size=None):
     assert node.op_type == 'RNN'
-    nf = NodeFactory(out_main_graph)
+    nf = NodeFactory(out_main_graph, main_initializers=main_initializers)
     with nf.scoped_prefix(node.output[0]) as scoped_prefix:
         X = node.input[0]
         Wa = nf.get_initializer(node.input[1])
@@ -477,13 +522,22 @@ def convert_rnn_to_scan(node, out_main_graph):
 
         InitHa = handle_init_state(InitHa, nf, num_directions)
 
-        batch_size, batch_node = handle_batch_size(X, nf, InitHa is None)
+        batch_size, batch_node = handle_batch_size(X, nf, InitHa is None, static_batch_size)
         if InitHa is None:
             zero_init_state = default_init_state(X, batch_size, batch_node, hidden_size, nf)
 
-        scan_outputs = []
-        scan_h_outputs = []
-        for direction_index in range(num_directions):
+        input_size = Wa.shape[len(Wa.shape) - 1]
+        X_2d, seq_batch_shape = flatten_input_for_gemm(X, nf, batch_size, input_size)
+        # transpose weights and sum biases for all directions at once
+        W_ts = np.ascontiguousarray(np.transpose(Wa, (0, 2, 1)), dtype=np.float32) # [num_directions, input_size, hidden_size]
+        R_ts = np.ascontiguousarray(np.transpose(Ra, (0, 2, 1)), dtype=np.float32) # [num_directions, hidden_size, hidden_size]
+        Bs = Ba.reshape(num_directions, 2, hidden_size).sum(axis=1, dtype=np.float32) # [num_directions, hidden_size]
+        X_projs = make_input_projection(X_2d, seq_batch_shape, W_ts, Bs, nf) # [seq_len, batch_size, hidden_size] for each direction
+
+        is_backwards = [0, 1] if num_directions == 2 else [0 if direction == 'forward' else 1]
+        init_states = [[zero_init_state if InitHa is None else InitHa[direction_index]] for direction_index in range(num_directions)]
+
+        def make_cell(nf_body, direction_index, name_prefix, prev_states, X_proj_subgraph):
             # for each direction
             # X [seq_len, batch_size, input_size]
             # W [hidden_size, input_size]
@@ -491,71 +545,18 @@ def convert_rnn_to_scan(node, out_main_graph):
             # B [2*hidden_size]
             # seq_len [batch_size]
             # init_h [batch_size, hidden_size]
+            prev_h_subgraph, = prev_states
+            R_t = R_ts[direction_index] # [hidden_size, hidden_size]
 
-            name_prefix = node.output[0] + '_' + str(direction_index) + '_'
-
-            if InitHa is None:
-                init_h = zero_init_state
-            else:
-                init_h = InitHa[direction_index]
-
-            input_size = Wa.shape[len(Wa.shape) - 1]
-            W_t = np.transpose(Wa[direction_index]) # [input_size, hidden_size]
-            R_t = np.transpose(Ra[direction_index]) # [hidden_size, hidden_size]
-            B = Ba[direction_index].reshape(2, hidden_size).sum(axis=0) # [hidden_size]
-            X_proj = nf.make_node('Add', [nf.make_node('MatMul', [X, W_t]), B]) #[seq_len, batch_size, hidden_size]
-            if num_directions == 1:
-                is_backward = 0 if direction == 'forward' else 1
-            else:
-                is_backward = direction_index
-
-            scan_body = onnx.GraphProto()
-            scan_body.name = name_prefix + '_subgraph'
-
-            nf_body = NodeFactory(out_main_graph, scan_body)
-            with nf_body.scoped_prefix(name_prefix) as body_scoped_prefix:
-                # subgraph inputs
-                X_proj_subgraph = X_proj.name + '_subgraph'
-                prev_h_subgraph = name_prefix + '_h_subgraph'
-
-                seq_len_subgraph = declare_seq_len_in_subgraph(seq_len, nf_body, X_proj.name, batch_size)
-
-                nf_body.make_value_info(prev_h_subgraph,
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, hidden_size),
-                                        usage=NodeFactory.ValueInfoType.input)
-
-                nf_body.make_value_info(X_proj_subgraph,
-                                        data_type=onnx.TensorProto.FLOAT,
-                                        shape=(batch_size, hidden_size),
-                                        usage=NodeFactory.ValueInfoType.input)
-                # subgraph nodes
-                # Ht = f(Xt*(W^T) + Ht-1*(R^T) + Wb + Rb)
-
-                activation_f = activations[direction_index]
-                Ht = nf_body.make_node(activation_f, nf_body.make_node('Add', [nf_body.make_node('MatMul', [prev_h_subgraph, R_t]), X_proj_subgraph]))
-
-                subgraph_outputs = handle_subgraph_outputs(nf_body,
-                                                           seq_len_subgraph,
-                                                           batch_size,
-                                                           hidden_size,
-                                                           [(Ht, prev_h_subgraph)] +
-                                                           ([(Ht, np.zeros(shape=(), dtype=np.float32))] if node.output[0] else []))
-
-                scan_attribs = {'body':scan_body,
-                                'scan_input_directions':[is_backward],
-                                'num_scan_inputs':1}
-                if node.output[0]:
-                    scan_attribs.update({'scan_output_directions':[is_backward]})
-                scan = nf.make_node('Scan', ([seq_len] if seq_len else []) + [init_h, X_proj],
-                                    scan_attribs,
-                                    output_names=[o.name for o in subgraph_outputs[(0 if seq_len else 1):]])
-
-                scan_h_outputs.append(subgraph_outputs[1])
-                if node.output[0]:
-                    scan_outputs.append(subgraph_outputs[2])
+            # subgraph nodes
+            # Ht = f(Xt*(W^T) + Ht-1*(R^T) + Wb + Rb)
+            activation_f = activations[direction_index]
+            Ht = nf_body.make_node(activation_f, nf_body.make_node('Add', [nf_body.make_node('MatMul', [prev_h_subgraph, R_t]), X_proj_subgraph]))
+            return [Ht]
 
-        handle_final_scan_outputs(node, nf, scan_outputs, [scan_h_outputs], num_directions)
+        scan_outputs, state_outputs = make_scans(node, nf, out_main_graph, main_initializers, seq_len, batch_size, hidden_size, hidden_size,
+                                                 X_projs, init_states, is_backwards, make_cell)
+        handle_final_scan_outputs(node, nf, scan_outputs, state_outputs, num_directions)
 
     # remove old initializers
     nf.remove_initializer(node.input[1])
@@ -566,49 +567,273 @@ def convert_rnn_to_scan(node, out_main_graph):
         nf.remove_initializer(node.input[5])
     return True
 
-def convert_to_scan_model(input_model, output_model):
+# initializers of the graph and its subgraphs
+def iterate_initializers(graph):
+    for i in graph.initializer:
+        yield i
+    for n in graph.node:
+        for attr in n.attribute:
+            for g in ([attr.g] if attr.HasField('g') else []) + list(attr.graphs):
+                yield from iterate_initializers(g)
+
+# save model, with tensors in external data of output_model + '.data' when use_external_data is set or they exceed protobuf size limit
+# tensors already in external data without being loaded are left as is
+def save_model(mp, output_model, use_external_data=False):
+    # the limit applies to the whole model, including initializers of Scan bodies
+    if use_external_data or mp.ByteSize() >= _PROTOBUF_SIZE_LIMIT:
+        # onnx appends tensors to an existing external data file, so remove a stale one unless tensors still refer to it
+        location = os.path.basename(output_model) + '.data'
+        keep_data = os.path.exists(output_model + '.data') and any([external_data_helper.uses_external_data(i) and
+                                                                    dict([(e.key, e.value) for e in i.external_data]).get('location') == location
+                                                                    for i in iterate_initializers(mp.graph)])
+        if os.path.exists(output_model + '.data') and not keep_data:
+            os.remove(output_model + '.data')
+        # location is relative to the directory of output_model
+        # newer onnx refuses to convert to an existing location, so tensors appended to a kept file are converted to a temporary location first
+        external_data_helper.convert_model_to_external_data(mp, all_tensors_to_one_file=True, location=location + '.tmp' if keep_data else location)
+        if keep_data:
+            for i in iterate_initializers(mp.graph):
+                for e in i.external_data:
+                    if e.key == 'location' and e.value == location + '.tmp':
+                        e.value = location
+    # write to a temporary file and rename it, so that output_model is replaced atomically
+    onnx.save(mp, output_model + '.tmp')
+    os.replace(output_model + '.tmp', output_model)
+
+# fold constants with onnxruntime basic graph optimizations, which do not depend on execution providers
+def fold_constants(input_model, output_model):
+    import onnxruntime
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC
+    sess_options.optimized_model_filepath = output_model
+    onnxruntime.InferenceSession(input_model, sess_options, providers=['CPUExecutionProvider'])
+
+# static_batch_size specializes converted models for the batch size, when it is symbolic in the input model
+# optimize_constants runs constant folding on the converted model, to trim runtime ops of constants
+# target_ep is the execution provider to run the output model, and LSTM/GRU/RNN are only converted for nuphar
+# use_external_data saves initializers to output_model + '.data', which is also done when they exceed protobuf size limit
+# returns the output model, so that it could be further processed without loading from output_model
+# output_model could be None to skip saving, when not using optimize_constants
+def convert_to_scan_model(input_model, output_model, static_batch_size=None, optimize_constants=False, target_ep='nuphar', use_external_data=False):
+    assert target_ep in _TARGET_EPS
     in_mp = onnx.load(input_model)
     out_mp = onnx.ModelProto()
     out_mp.CopyFrom(in_mp)
     out_mp.ir_version = 5 # update ir version to avoid requirement of initializer in graph input
     ensure_opset(out_mp, 9) # bump up to ONNX opset 9, which is required for Scan
     out_mp.graph.ClearField('node')
+    # in_mp.graph is never mutated during conversion, so the index is built only once
+    consumer_index = build_consumer_index(in_mp.graph)
+    graph_outputs = frozenset(o.name for o in in_mp.graph.output)
+    # shared initializer lookup for all conversions, to avoid linear search of initializers per weight/bias
+    main_initializers = dict([(i.name, i) for i in out_mp.graph.initializer])
+    # nodes to copy as is are added in batches, which are flushed before converting LSTM/GRU/RNN to keep the order of nodes
+    pending_nodes = []
+    # converters by op_type, so that each node needs only one lookup
+    converters = {'LSTM':convert_lstm_to_scan, 'GRU':convert_gru_to_scan, 'RNN':convert_rnn_to_scan} if target_ep == 'nuphar' else {}
     for in_n in in_mp.graph.node:
         if in_n.op_type in ['LSTM', 'GRU', 'RNN']:
-            in_n = trim_unused_outputs(in_n, in_mp.graph)
-        if in_n.op_type == 'LSTM':
-            if convert_lstm_to_scan(in_n, out_mp.graph):
+            in_n = trim_unused_outputs(in_n, consumer_index, graph_outputs)
+        converter = converters.get(in_n.op_type)
+        if converter:
+            out_mp.graph.node.extend(pending_nodes)
+            pending_nodes = []
+            if converter(in_n, out_mp.graph, main_initializers, static_batch_size):
                 continue
-        if in_n.op_type == 'GRU':
-            if convert_gru_to_scan(in_n, out_mp.graph):
-                continue
-        if in_n.op_type == 'RNN':
-            if convert_rnn_to_scan(in_n, out_mp.graph):
-                continue
-        out_n = out_mp.graph.node.add()
-        out_n.CopyFrom(in_n)
-
-    onnx.save(out_mp, output_model)
+        pending_nodes.append(in_n)
+    out_mp.graph.node.extend(pending_nodes)
+
+    if optimize_constants:
+        # constant folding works on files, so output_model is needed
+        assert output_model
+        save_model(out_mp, output_model, use_external_data)
+        fold_constants(output_model, output_model)
+        if use_external_data:
+            # onnxruntime may write the optimized model with all initializers inline, orphaning output_model + '.data'
+            # so load all tensors and save them to external data again
+            save_model(onnx.load(output_model), output_model, use_external_data)
+        return onnx.load(output_model, load_external_data=False)
+    if output_model:
+        save_model(out_mp, output_model, use_external_data)
+    return out_mp
+
+# field numbers in onnx.proto, to scan serialized models without parsing them
+def _field_number(message_type, field_name):
+    return message_type.DESCRIPTOR.fields_by_name[field_name].number
+
+_MODEL_GRAPH = _field_number(onnx.ModelProto, 'graph')
+_GRAPH_NODE = _field_number(onnx.GraphProto, 'node')
+_GRAPH_INITIALIZER = _field_number(onnx.GraphProto, 'initializer')
+_GRAPH_INPUT = _field_number(onnx.GraphProto, 'input')
+_NODE_OP_TYPE = _field_number(onnx.NodeProto, 'op_type')
+_NODE_ATTRIBUTE = _field_number(onnx.NodeProto, 'attribute')
+_ATTRIBUTE_NAME = _field_number(onnx.AttributeProto, 'name')
+_ATTRIBUTE_G = _field_number(onnx.AttributeProto, 'g')
+_TENSOR_NAME = _field_number(onnx.TensorProto, 'name')
+_TENSOR_DATA_LOCATION = _field_number(onnx.TensorProto, 'data_location')
+_VALUE_INFO_NAME = _field_number(onnx.ValueInfoProto, 'name')
+
+def _decode_varint(buf, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+# iterate over fields of serialized message in buf[start:end], yielding field number and range of the value
+# values are not decoded, so skipping length-delimited fields like raw_data of tensors does not read them
+def _iterate_fields(buf, start, end):
+    pos = start
+    while pos < end:
+        key, pos = _decode_varint(buf, pos)
+        wire_type = key & 7
+        value_start = pos
+        if wire_type == 0:
+            _, pos = _decode_varint(buf, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, value_start = _decode_varint(buf, pos)
+            pos = value_start + length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type ' + str(wire_type))
+        yield key >> 3, value_start, pos
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+# get string field of serialized message in buf[start:end]
+def _get_string_field(buf, start, end, field_number):
+    value = None
+    for field, value_start, value_end in _iterate_fields(buf, start, end):
+        if field == field_number:
+            value = bytes(buf[value_start:value_end]).decode('utf-8')
+    return value
+
+# name of subgraph attribute by op_type, both as serialized in models
+_SUBGRAPH_ATTRIBUTES = {b'Scan':b'body'} # currently only handle Scan
+
+# get ranges of subgraphs in serialized node of buf[start:end]
+# op_type is looked up in _SUBGRAPH_ATTRIBUTES once, and attributes are only decoded for nodes with subgraphs
+def _get_subgraphs(buf, start, end):
+    fields = list(_iterate_fields(buf, start, end))
+    subgraph_attribute = None
+    for field, value_start, value_end in fields:
+        if field == _NODE_OP_TYPE:
+            subgraph_attribute = _SUBGRAPH_ATTRIBUTES.get(bytes(buf[value_start:value_end]))
+    if not subgraph_attribute:
+        return []
+    attributes = [dict([(f, (s, e)) for f, s, e in _iterate_fields(buf, a_start, a_end)]) for field, a_start, a_end in fields if field == _NODE_ATTRIBUTE]
+    return [attr[_ATTRIBUTE_G] for attr in attributes if _ATTRIBUTE_G in attr and buf[slice(*attr[_ATTRIBUTE_NAME])] == subgraph_attribute]
+
+# check if any initializer in graphs and their Scan bodies is stored in external data
+def _has_external_data(buf, graphs):
+    while graphs:
+        graph_start, graph_end = graphs.pop()
+        for field, start, end in _iterate_fields(buf, graph_start, graph_end):
+            if field == _GRAPH_INITIALIZER:
+                for tensor_field, value_start, value_end in _iterate_fields(buf, start, end):
+                    if tensor_field == _TENSOR_DATA_LOCATION and _decode_varint(buf, value_start)[0] == onnx.TensorProto.EXTERNAL:
+                        return True
+            elif field == _GRAPH_NODE:
+                graphs += _get_subgraphs(buf, start, end)
+    return False
+
+# write serialized model in buf to output_model, with graph inputs in drop_names removed
+# other fields are copied as is in chunks, so the output is written incrementally without parsing or serializing tensors
+def _write_model_without_inputs(buf, output_model, drop_names):
+    with open(output_model, 'wb') as f:
+        copied = 0
+        field_start = 0
+        for field, start, end in _iterate_fields(buf, 0, len(buf)):
+            if field == _MODEL_GRAPH:
+                f.write(buf[copied:field_start])
+                # ranges of graph fields to keep, with adjacent ranges merged
+                kept_ranges = []
+                graph_field_start = start
+                for graph_field, graph_start, graph_end in _iterate_fields(buf, start, end):
+                    if not (graph_field == _GRAPH_INPUT and _get_string_field(buf, graph_start, graph_end, _VALUE_INFO_NAME) in drop_names):
+                        if kept_ranges and kept_ranges[-1][1] == graph_field_start:
+                            kept_ranges[-1] = (kept_ranges[-1][0], graph_end)
+                        else:
+                            kept_ranges.append((graph_field_start, graph_end))
+                    graph_field_start = graph_end
+                # graph is length-delimited, which is wire type 2
+                f.write(_encode_varint(_MODEL_GRAPH << 3 | 2) + _encode_varint(sum([e - s for s, e in kept_ranges])))
+                for s, e in kept_ranges:
+                    f.write(buf[s:e])
+                copied = end
+            field_start = end
+        f.write(buf[copied:])
 
 # Old models (ir_version < 4) is required to initializers in graph inputs
 # This is optional for ir_version >= 4
-def remove_initializers_from_inputs(input_model, output_model, remain_inputs=[]):
-    mp = onnx.load(input_model)
-
-    def _append_initializer_from_graph(graph):
-        initializers = [i.name for i in graph.initializer]
-        for node in graph.node:
-            if node.op_type == 'Scan': # currently only handle Scan
-                subgraph = NodeFactory.get_attribute(node, 'body')
-                initializers += _append_initializer_from_graph(subgraph)
+# only graph inputs are edited, so tensors in external data are not loaded, and output_model keeps referencing them
+# returns the output model like convert_to_scan_model when it is parsed, otherwise None
+# locations of external data are relative to the model, so when output_model is in another directory,
+# external data is loaded and saved to output_model + '.data' instead
+def remove_initializers_from_inputs(input_model, output_model, remain_inputs=None, use_external_data=False):
+    remain_inputs = frozenset(remain_inputs) if remain_inputs else frozenset()
+
+    # find initializers in graphs and their Scan bodies among input_names, with a worklist of graphs instead of recursion
+    # graphs are not visited once all input_names are matched
+    def _append_initializer_from_graph(buf, graphs, input_names):
+        initializers = set()
+        while graphs and len(initializers) < len(input_names):
+            graph_start, graph_end = graphs.pop()
+            for field, start, end in _iterate_fields(buf, graph_start, graph_end):
+                if field == _GRAPH_INITIALIZER:
+                    name = _get_string_field(buf, start, end, _TENSOR_NAME)
+                    if name in input_names:
+                        initializers.add(name)
+                elif field == _GRAPH_NODE:
+                    graphs += _get_subgraphs(buf, start, end)
         return initializers
 
-    all_initializer_names = [n for n in _append_initializer_from_graph(mp.graph) if n not in remain_inputs]
-    new_inputs = [vi for vi in mp.graph.input if not vi.name in all_initializer_names]
-    mp.graph.ClearField('input')
-    mp.graph.input.extend(new_inputs)
-    onnx.save(mp, output_model)
+    # names are found by scanning the serialized model, which skips tensor data instead of parsing it
+    with open(input_model, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as buf:
+                main_graphs = [(start, end) for field, start, end in _iterate_fields(buf, 0, len(buf)) if field == _MODEL_GRAPH]
+                input_names = set([_get_string_field(buf, start, end, _VALUE_INFO_NAME) for graph_start, graph_end in main_graphs
+                                   for field, start, end in _iterate_fields(buf, graph_start, graph_end) if field == _GRAPH_INPUT])
+                # use sets for names, to avoid linear search per graph input
+                all_initializer_names = _append_initializer_from_graph(buf, list(main_graphs), input_names - remain_inputs)
+                relocate_external_data = (os.path.dirname(os.path.realpath(input_model)) != os.path.dirname(os.path.realpath(output_model)) and
+                                          _has_external_data(buf, list(main_graphs)))
+                if all_initializer_names and not (use_external_data or relocate_external_data):
+                    # write to a temporary file first, since the input is still mapped when output_model is input_model
+                    _write_model_without_inputs(buf, output_model + '.tmp', all_initializer_names)
+
+    if not (use_external_data or relocate_external_data):
+        if all_initializer_names:
+            os.replace(output_model + '.tmp', output_model)
+        elif not (os.path.exists(output_model) and os.path.samefile(input_model, output_model)):
+            # nothing to remove, so just copy the file
+            shutil.copyfile(input_model, output_model)
+        return None
+
+    # tensors need to be converted to external data, or moved next to output_model, so parse the model
+    mp = onnx.load(input_model, load_external_data=relocate_external_data)
+    # delete inputs in place from the back, so that remaining inputs are not copied
+    drop_indices = [i for i, vi in enumerate(mp.graph.input) if vi.name in all_initializer_names]
+    for i in reversed(drop_indices):
+        del mp.graph.input[i]
+    save_model(mp, output_model, use_external_data or relocate_external_data)
+    return mp
 
+# output_model could be None to skip saving, like convert_to_scan_model
 def optimize_input_projection(input_model, output_model):
     in_mp = onnx.load(input_model)
     out_mp = onnx.ModelProto()
@@ -706,7 +931,97 @@ def optimize_input_projection(input_model, output_model):
         scan.name = in_n.name
         scan.doc_string = in_n.doc_string
 
-    onnx.save(out_mp, output_model)
+    if output_model:
+        onnx.save(out_mp, output_model)
+    return out_mp
+
+# hash fields of model one by one, so that the model is never serialized as a whole, which would double memory or exceed protobuf size limit
+# graphs, nodes and attributes are walked down to tensors, whose raw_data is hashed as is, while other messages are serialized separately
+_HASH_WALKED_TYPES = [onnx.GraphProto.DESCRIPTOR, onnx.NodeProto.DESCRIPTOR, onnx.AttributeProto.DESCRIPTOR, onnx.TensorProto.DESCRIPTOR]
+
+# FieldDescriptor.label is replaced by is_repeated in newer protobuf
+def _is_repeated(field):
+    return field.is_repeated if hasattr(field, 'is_repeated') else field.label == field.LABEL_REPEATED
+
+def _hash_message(model_hash, message):
+    for field, value in message.ListFields():
+        for v in (value if _is_repeated(field) else [value]):
+            model_hash.update(_encode_varint(field.number))
+            if field.message_type in _HASH_WALKED_TYPES:
+                _hash_message(model_hash, v)
+                # mark the end of walked message, since its length is unknown
+                model_hash.update(_encode_varint(0))
+                continue
+            if field.message_type:
+                data = v.SerializeToString()
+            elif field.type == field.TYPE_BYTES:
+                data = v
+            else:
+                data = str(v).encode('utf-8')
+            model_hash.update(_encode_varint(len(data)))
+            model_hash.update(data)
+
+# copy model file and its external data in src_model + '.data' when external_data is set
+# dst_model is replaced atomically, after its external data is in place
+def _copy_model(src_model, dst_model, external_data):
+    if external_data:
+        shutil.copyfile(src_model + '.data', dst_model + '.data.tmp')
+        os.replace(dst_model + '.data.tmp', dst_model + '.data')
+    shutil.copyfile(src_model, dst_model + '.tmp')
+    os.replace(dst_model + '.tmp', dst_model)
+
+# run symbolic shape inference on model, and save the result to model_path
+# when mp is given, shapes are inferred on it in memory, so model_path is only written once with the result
+# otherwise model_path is loaded without its external data, which is kept as is in the result
+# with cache_dir, results are cached by hash of the model, so that re-running on the same model just copies the cached result
+# cached results include external data written to model_path + '.data', whose name and use_external_data are part of the key
+def infer_shapes_with_cache(model_path, cache_dir=None, mp=None, use_external_data=False):
+    if mp is None:
+        mp = onnx.load(model_path, load_external_data=False)
+    # tensors in external data that are not loaded are referenced by files outside of the cache, and saving may append to them
+    if cache_dir and any([external_data_helper.uses_external_data(i) for i in iterate_initializers(mp.graph)]):
+        cache_dir = None
+    if cache_dir:
+        model_hash = hashlib.blake2b(digest_size=16)
+        model_hash.update('{}:{}:'.format(os.path.basename(model_path), use_external_data).encode('utf-8'))
+        # cached results are invalidated when inference code, onnx or options change
+        with open(sys.modules[SymbolicShapeInference.__module__].__file__, 'rb') as f:
+            model_hash.update(f.read())
+        model_hash.update('{}:{}:'.format(onnx.__version__, sorted(_SHAPE_INFER_OPTIONS.items())).encode('utf-8'))
+        _hash_message(model_hash, mp)
+        cached_model = os.path.join(cache_dir, model_hash.hexdigest() + '.onnx')
+        if os.path.exists(cached_model):
+            _copy_model(cached_model, model_path, os.path.exists(cached_model + '.data'))
+            return
+    if get_opset(mp) < 7:
+        logger.warning('Only support models of opset 7 and above.')
+        out_mp = mp
+        save_model(out_mp, model_path, use_external_data)
+    else:
+        # shape inference may read initializer values, which numpy_helper resolves relative to the working directory when in external data
+        # so those initializers are loaded from the directory of model_path for inference, and restored to external data in the result
+        external_initializers = {}
+        for i in iterate_initializers(mp.graph):
+            if external_data_helper.uses_external_data(i):
+                external_initializers[i.name] = [(e.key, e.value) for e in i.external_data]
+                external_data_helper.load_external_data_for_tensor(i, os.path.dirname(model_path))
+                i.data_location = onnx.TensorProto.DEFAULT
+                del i.external_data[:]
+        out_mp, all_shapes_inferred = SymbolicShapeInference.infer_shapes_from_model(mp, **_SHAPE_INFER_OPTIONS)
+        for i in iterate_initializers(out_mp.graph):
+            if i.name in external_initializers:
+                i.ClearField('raw_data')
+                i.data_location = onnx.TensorProto.EXTERNAL
+                for key, value in external_initializers[i.name]:
+                    entry = i.external_data.add()
+                    entry.key = key
+                    entry.value = value
+        save_model(out_mp, model_path, use_external_data)
+        if not all_shapes_inferred:
+            sys.exit(1)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        _copy_model(model_path, cached_model, any([external_data_helper.uses_external_data(i) for i in iterate_initializers(out_mp.graph)]))
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -716,23 +1031,32 @@ def parse_arguments():
                                  'remove_initializers_from_inputs'])
     parser.add_argument('--input', help='The input model file', default=None)
     parser.add_argument('--output', help='The output model file', default=None)
+    parser.add_argument('--static_batch_size', help='Specialize to_scan conversion for the batch size, if it is symbolic in the input model', type=int, default=None)
+    parser.add_argument('--optimize_constants', help='Fold constants in to_scan output model with onnxruntime basic graph optimizations', action='store_true', default=False)
+    parser.add_argument('--use_external_data', help='Save initializers of to_scan/remove_initializers_from_inputs output model as external data', action='store_true', default=False)
+    parser.add_argument('--target_ep', help='The execution provider for to_scan output model. LSTM/GRU/RNN are kept as is for non-nuphar providers', choices=_TARGET_EPS, default='nuphar')
+    parser.add_argument('--cache_shape_inference', help='Cache symbolic shape inference results of output models in ' + _SHAPE_INFER_CACHE_DIR, action='store_true', default=False)
+    parser.add_argument('-q', '--quiet', help='Do not log progress', action='store_true', default=False)
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_arguments()
-    print('input model: ' + args.input)
-    print('output model ' + args.output)
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format='%(message)s')
+    logger.info('input model: %s', args.input)
+    logger.info('output model %s', args.output)
+    out_mp = None
     if args.mode == 'to_scan':
-        print('Convert LSTM/GRU/RNN to Scan...')
-        convert_to_scan_model(args.input, args.output)
+        logger.info('Convert LSTM/GRU/RNN to Scan...')
+        # output is saved after shape inference, unless it is needed as a file for constant folding
+        out_mp = convert_to_scan_model(args.input, args.output if args.optimize_constants else None, args.static_batch_size, args.optimize_constants, args.target_ep, args.use_external_data)
     elif args.mode == 'opt_inproj':
-        print('Optimize input projection in Scan...')
-        optimize_input_projection(args.input, args.output)
+        logger.info('Optimize input projection in Scan...')
+        out_mp = optimize_input_projection(args.input, None)
     elif args.mode == 'remove_initializers_from_inputs':
-        print('Remove all initializers from input for model with IR version >= 4...')
-        remove_initializers_from_inputs(args.input, args.output)
+        logger.info('Remove all initializers from input for model with IR version >= 4...')
+        out_mp = remove_initializers_from_inputs(args.input, args.output, use_external_data=args.use_external_data)
     else:
         raise NotImplementedError('Unknown mode')
-    print('Running symbolic shape inference on output model')
-    SymbolicShapeInference.infer_shapes(args.output, args.output, auto_merge=True)
-    print('Done!')
+    logger.info('Running symbolic shape inference on output model')
+    infer_shapes_with_cache(args.output, _SHAPE_INFER_CACHE_DIR if args.cache_shape_inference else None, out_mp, args.use_external_data)
+    logger.info('Done!')
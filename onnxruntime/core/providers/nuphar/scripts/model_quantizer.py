@@ -53,16 +53,23 @@ class QuantizeConfig:
                      ('QuantizationType', 'Signed' if self.sign_bit_ else 'Unsigned'),
                      ('ReservedBit', self.reserved_bits_)])
 
+# Gemm without transpose and scaling is MatMul + Add, like the input projection emitted by model_editor
+def is_matmul_gemm(node):
+    return (node.op_type == 'Gemm' and
+            NodeFactory.get_attribute(node, 'alpha', 1.0) == 1.0 and
+            NodeFactory.get_attribute(node, 'beta', 1.0) == 1.0 and
+            NodeFactory.get_attribute(node, 'transA', 0) == 0 and
+            NodeFactory.get_attribute(node, 'transB', 0) == 0)
+
 def quantize_matmul_2d_with_weight(in_node, in_graph, nf, converted_weights, quantized_inputs, qcfg_dict, update_qcfg_dict, default_qcfg):
-    assert in_node.op_type == 'MatMul'
+    assert in_node.op_type == 'MatMul' or is_matmul_gemm(in_node)
 
     # quantize weight
     # only handles weight being inputs[1] of MatMul/Gemm node
     fparam_name = in_node.input[1]
 
-    # skip if weights shared by other nodes that's not MatMul
-    # TODO: support GEMM op if needed
-    other_nodes = [n for n in in_graph.node if n != in_node and fparam_name in n.input and n.op_type != 'MatMul']
+    # skip if weights shared by other nodes that's not MatMul or MatMul-like Gemm
+    other_nodes = [n for n in in_graph.node if n != in_node and fparam_name in n.input and not (n.op_type == 'MatMul' or is_matmul_gemm(n))]
     if other_nodes:
         return False
 
@@ -180,19 +187,24 @@ def quantize_matmul_2d_with_weight(in_node, in_graph, nf, converted_weights, qua
             Q_Y.domain = "com.microsoft"
 
         # Dequantize
-        Y = in_node.output[0]
+        # for Gemm, dequantize to an intermediate and add bias C afterwards
+        has_bias = in_node.op_type == 'Gemm' and len(in_node.input) > 2 and in_node.input[2]
+        Y = None if has_bias else in_node.output[0]
         if symmetric:
-            nf.make_node('Mul',
-                      [nf.make_node('Mul', [step, scale_X]),
-                       nf.make_node('Cast', Q_Y, {'to': int(onnx.TensorProto.FLOAT)})],
-                      output_names=Y)
+            Y = nf.make_node('Mul',
+                          [nf.make_node('Mul', [step, scale_X]),
+                           nf.make_node('Cast', Q_Y, {'to': int(onnx.TensorProto.FLOAT)})],
+                          output_names=Y)
         else:
             o0 = nf.make_node('Mul', [nf.make_node('Mul', [step, scale_X]),
                                       nf.make_node('Cast', Q_Y, {'to': int(onnx.TensorProto.FLOAT)})])
             o1 = nf.make_node('Mul', [nf.make_node('Mul', [step, bias_X]), qparam_rowsum])
             o2 = nf.make_node('Mul', [base, nf.make_node('Mul', [scale_X, nf.make_node('Cast', Q_X_sum_int32, {'to':int(onnx.TensorProto.FLOAT)})])])
             o3 = nf.make_node('Mul', [base, nf.make_node('Mul', [bias_X, np.asarray(float(input_dim)).astype(np.float32)])])
-            nf.make_node('Sum', [o3, o2, o1, o0], output_names=Y)
+            Y = nf.make_node('Sum', [o3, o2, o1, o0], output_names=Y)
+
+        if has_bias:
+            nf.make_node('Add', [Y, in_node.input[2]], output_names=in_node.output[0])
 
     if update_qcfg_dict:
         qcfg_dict[in_node.output[0]] = node_qcfg
@@ -248,7 +260,7 @@ def convert_matmul_model(input_model, output_model, only_for_scan=False, share_i
         if upgrade_op(nf, in_n):
             continue
 
-        if in_n.op_type == 'MatMul' and not only_for_scan:
+        if (in_n.op_type == 'MatMul' or is_matmul_gemm(in_n)) and not only_for_scan:
             if quantize_matmul_2d_with_weight(in_n, in_mp.graph, nf, converted_weights, quantized_inputs, qcfg_dict, export_qcfg_json, default_qcfg):
                 continue
 
@@ -261,7 +273,7 @@ def convert_matmul_model(input_model, output_model, only_for_scan=False, share_i
             scan_nf = NodeFactory(out_mp.graph, out_subgraph)
             subgraph_quantized_inputs = {} if share_input_quantization else None # remember quantized inputs that might be able to share between MatMuls
             for in_sn in in_subgraph.node:
-                if in_sn.op_type == 'MatMul':
+                if in_sn.op_type == 'MatMul' or is_matmul_gemm(in_sn):
                     if quantize_matmul_2d_with_weight(in_sn, in_subgraph, scan_nf, converted_weights, subgraph_quantized_inputs, qcfg_dict, export_qcfg_json, default_qcfg):
                         continue
 
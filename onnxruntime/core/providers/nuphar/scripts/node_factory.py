@@ -13,10 +13,15 @@ class NodeFactory:
     node_count_ = 0
     const_count_ = 0
 
-    def __init__(self, main_graph, sub_graph=None, prefix=''):
+    def __init__(self, main_graph, sub_graph=None, prefix='', main_initializers=None):
         self.graph_ = sub_graph if sub_graph else main_graph
         self.main_graph_ = main_graph
         self.name_prefix_ = prefix
+        # optional name -> TensorProto dict of main graph initializers, which could be shared between NodeFactory instances
+        # to avoid linear search in main graph initializers. It is kept in sync by make_initializer/remove_initializer
+        self.main_initializers_ = main_initializers
+        # (usage, name) -> ValueInfoProto made by this NodeFactory, to avoid linear search and duplicated declarations
+        self.value_infos_ = {}
 
     class ScopedPrefix:
         def __init__(self, nf, name):
@@ -36,13 +41,26 @@ class NodeFactory:
     def get_prefix(self, prefix):
         return self.name_prefix_
 
+    def _find_initializer(self, name):
+        if self.main_initializers_ is None:
+            candidates = list(self.main_graph_.initializer) + list(self.graph_.initializer)
+        else:
+            if name in self.main_initializers_:
+                return self.main_initializers_[name]
+            candidates = self.graph_.initializer if self.main_graph_ is not self.graph_ else []
+        found = [i for i in candidates if i.name == name]
+        return found[0] if found else None
+
     def get_initializer(self, name):
-        found = [i for i in list(self.main_graph_.initializer) + list(self.graph_.initializer) if i.name == name]
-        if found:
-            return numpy_helper.to_array(found[0])
+        found = self._find_initializer(name)
+        if found is not None:
+            return numpy_helper.to_array(found)
         return None
 
     def get_value_info(self, name):
+        for usage in [None, NodeFactory.ValueInfoType.input]:
+            if (usage, name) in self.value_infos_:
+                return self.value_infos_[(usage, name)]
         found = [vi for vi in list(self.graph_.value_info) + list(self.graph_.input) if vi.name == name]
         if found:
             return found[0]
@@ -56,6 +74,8 @@ class NodeFactory:
                 continue
             assert not removed
             graph.initializer.remove(initializer[0])
+            if graph is self.main_graph_ and self.main_initializers_ is not None:
+                self.main_initializers_.pop(name, None)
             initializer_in_input = [i for i in graph.input if i.name == name]
             if initializer_in_input:
                 graph.input.remove(initializer_in_input[0])
@@ -74,33 +94,40 @@ class NodeFactory:
         output = 2
 
     def make_value_info(self, node_or_name, data_type, shape=None, usage=None):
-        if usage == NodeFactory.ValueInfoType.input:
-            value_info = self.graph_.input.add()
-        elif usage == NodeFactory.ValueInfoType.output:
-            value_info = self.graph_.output.add()
-        elif not usage:
-            value_info = self.graph_.value_info.add()
-        else:
-            raise NotImplementedError("unknown usage")
-
         if type(node_or_name) == str:
             name = node_or_name
         else:
             assert len(node_or_name.output) == 1
             name = node_or_name.output[0]
 
+        value_info = self.value_infos_.get((usage, name))
+        if value_info is None:
+            if usage == NodeFactory.ValueInfoType.input:
+                value_info = self.graph_.input.add()
+            elif usage == NodeFactory.ValueInfoType.output:
+                value_info = self.graph_.output.add()
+            elif not usage:
+                value_info = self.graph_.value_info.add()
+            else:
+                raise NotImplementedError("unknown usage")
+            self.value_infos_[(usage, name)] = value_info
+
         value_info.CopyFrom(helper.make_tensor_value_info(name, data_type, shape))
 
     def make_initializer(self, ndarray, name='', in_main_graph=False):
-        new_initializer = (self.main_graph_ if in_main_graph else self.graph_).initializer.add()
+        target_graph = self.main_graph_ if in_main_graph else self.graph_
         new_name = name
         if len(new_name) == 0:
             already_existed = True
             while already_existed:
                 new_name = self.name_prefix_ + '_Const_' + str(NodeFactory.const_count_)
                 NodeFactory.const_count_ = NodeFactory.const_count_ + 1
-                already_existed = new_name in [i.name for i in list(self.main_graph_.initializer) + list(self.graph_.initializer)]
+                already_existed = self._find_initializer(new_name) is not None
+        new_initializer = target_graph.initializer.add()
+        # numpy_helper.from_array stores tensor in raw_data, which is compact and fast to load, unlike float_data
         new_initializer.CopyFrom(numpy_helper.from_array(ndarray, new_name))
+        if target_graph is self.main_graph_ and self.main_initializers_ is not None:
+            self.main_initializers_[new_name] = new_initializer
         return new_initializer
 
     def make_node(self, op_type, inputs, attributes={}, output_names=None, node=None):
@@ -333,6 +333,9 @@ class SymbolicShapeInference:
             self.tmp_mp_ = shape_inference.infer_shapes(self.tmp_mp_)
         for i_o in range(len(node.output)):
             o = node.output[i_o]
+            # omitted optional outputs have no value info
+            if not o:
+                continue
             vi = self.out_mp_.graph.value_info.add()
             if not skip_infer:
                 vi.CopyFrom(self.tmp_mp_.graph.output[i_o])
@@ -1140,6 +1143,9 @@ class SymbolicShapeInference:
                         self._check_merged_dims(in_dims, allow_broadcast=True)
 
             for i_o in range(len(node.output)):
+                # omitted optional outputs, like trimmed outputs of LSTM/GRU/RNN
+                if not node.output[i_o]:
+                    continue
                 vi = self.known_vi_[node.output[i_o]]
                 out_type = vi.type
                 out_type_kind = out_type.WhichOneof('value')
@@ -1213,7 +1219,8 @@ class SymbolicShapeInference:
                             print(self.known_vi_[i])
                         print('node outputs:')
                         for o in node.output:
-                            print(self.known_vi_[o])
+                            if o:
+                                print(self.known_vi_[o])
                         if self.auto_merge_ and not out_type_undefined:
                             print('Merging: ' + str(self.suggested_merge_))
                     return False
@@ -1226,20 +1233,27 @@ class SymbolicShapeInference:
             if output.name in self.known_vi_:
                 output.CopyFrom(self.known_vi_[output.name])
 
+    # infer shapes of in-memory model, returns the model with inferred shapes, and whether all shapes are inferred
     @staticmethod
-    def infer_shapes(input_model, output_model, int_max=2**31 - 1, auto_merge=False, guess_output_rank=False, verbose=0):
-        in_mp = onnx.load(input_model)
-        if get_opset(in_mp) < 7:
-            print('Only support models of opset 7 and above.')
-            return
+    def infer_shapes_from_model(in_mp, int_max=2**31 - 1, auto_merge=False, guess_output_rank=False, verbose=0):
+        assert get_opset(in_mp) >= 7
         symbolic_shape_inference = SymbolicShapeInference(int_max, auto_merge, guess_output_rank, verbose)
         all_shapes_inferred = False
         symbolic_shape_inference._preprocess(in_mp)
         while symbolic_shape_inference.run_:
             all_shapes_inferred = symbolic_shape_inference._infer_impl(in_mp)
         symbolic_shape_inference._update_output_from_vi()
+        return symbolic_shape_inference.out_mp_, all_shapes_inferred
+
+    @staticmethod
+    def infer_shapes(input_model, output_model, int_max=2**31 - 1, auto_merge=False, guess_output_rank=False, verbose=0):
+        in_mp = onnx.load(input_model)
+        if get_opset(in_mp) < 7:
+            print('Only support models of opset 7 and above.')
+            return
+        out_mp, all_shapes_inferred = SymbolicShapeInference.infer_shapes_from_model(in_mp, int_max, auto_merge, guess_output_rank, verbose)
         if output_model:
-            onnx.save(symbolic_shape_inference.out_mp_, output_model)
+            onnx.save(out_mp, output_model)
         if not all_shapes_inferred:
             sys.exit(1)
 
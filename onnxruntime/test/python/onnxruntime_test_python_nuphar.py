@@ -2,18 +2,23 @@
 # Licensed under the MIT License.
 
 # -*- coding: UTF-8 -*-
+import hashlib
 import numpy as np
 import onnx
-from onnx import numpy_helper
+from onnx import external_data_helper, helper, numpy_helper
 import onnxruntime as onnxrt
 import os
+from onnxruntime.nuphar import model_editor
+from onnxruntime.nuphar.model_editor import _hash_message, infer_shapes_with_cache, iterate_initializers, remove_initializers_from_inputs
 from onnxruntime.nuphar.rnn_benchmark import perf_test, generate_model
 from pathlib import Path
 import shutil
 import sys
 import subprocess
 import tarfile
+import tempfile
 import unittest
+import unittest.mock
 import urllib.request
 
 class TestNuphar(unittest.TestCase):
@@ -171,6 +176,141 @@ class TestNuphar(unittest.TestCase):
         scan_batch_data_output = sess.run([], {'input':data_input[:,0:1,:], 'seq_len':data_seq_len[0:1]})
         assert np.allclose(first_lstm_data_output, scan_batch_data_output)
 
+    def test_static_batch_scan(self):
+        input_dim = 3
+        hidden_dim = 5
+        bidirectional = False
+        layers = 3
+
+        lstm_model_name = 'test_static_batch_rnn_lstm.onnx'
+        # create an LSTM model for generating baseline data
+        generate_model('lstm', input_dim, hidden_dim, bidirectional, layers, lstm_model_name, batch_one=False, has_seq_len=True)
+
+        seq_len = 8
+        batch_size = 2
+        # prepare input
+        data_input = (np.random.rand(seq_len, batch_size, input_dim) * 2 - 1).astype(np.float32)
+        data_seq_len = np.random.randint(1, seq_len, size=(batch_size,), dtype=np.int32)
+
+        # run lstm as baseline
+        sess = onnxrt.InferenceSession(lstm_model_name)
+        lstm_data_output = sess.run([], {'input':data_input, 'seq_len':data_seq_len})
+
+        # generate a scan model specialized to batch size
+        scan_model_name = 'test_static_batch_rnn_scan.onnx'
+        subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.model_editor', '--input', lstm_model_name, '--output', scan_model_name, '--mode', 'to_scan', '--static_batch_size', str(batch_size)], check=True)
+
+        # symbolic batch dims in graph inputs are pinned to batch size
+        scan_mp = onnx.load(scan_model_name)
+        assert [n.op_type for n in scan_mp.graph.node if n.op_type in ['LSTM', 'GRU', 'RNN']] == []
+        input_dims = dict([(i.name, [d.dim_param if d.HasField('dim_param') else d.dim_value for d in i.type.tensor_type.shape.dim]) for i in scan_mp.graph.input])
+        assert input_dims['input'] == ['s', batch_size, input_dim]
+        assert input_dims['seq_len'] == [batch_size]
+
+        # run scan with the static batch size
+        sess = onnxrt.InferenceSession(scan_model_name)
+        scan_data_output = sess.run([], {'input':data_input, 'seq_len':data_seq_len})
+        assert np.allclose(lstm_data_output, scan_data_output)
+
+    def test_scan_external_data(self):
+        input_dim = 32
+        hidden_dim = 32
+        layers = 2
+
+        lstm_model_name = 'test_external_data_rnn_lstm.onnx'
+        generate_model('lstm', input_dim, hidden_dim, False, layers, lstm_model_name, batch_one=False, has_seq_len=True)
+
+        seq_len = 8
+        batch_size = 2
+        data_input = (np.random.rand(seq_len, batch_size, input_dim) * 2 - 1).astype(np.float32)
+        data_seq_len = np.random.randint(1, seq_len, size=(batch_size,), dtype=np.int32)
+        sess = onnxrt.InferenceSession(lstm_model_name)
+        lstm_data_output = sess.run([], {'input':data_input, 'seq_len':data_seq_len})
+
+        scan_model_name = 'test_external_data_rnn_scan.onnx'
+        for optimize_constants in [False, True]:
+            # stale external data file from a previous run is not appended to
+            with open(scan_model_name + '.data', 'wb') as f:
+                f.write(b'\0' * 4096)
+            for run in range(2):
+                subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.model_editor', '--input', lstm_model_name, '--output', scan_model_name, '--mode', 'to_scan', '--use_external_data'] +
+                               (['--optimize_constants'] if optimize_constants else []), check=True)
+                scan_mp = onnx.load(scan_model_name, load_external_data=False)
+                external_lengths = [int(dict([(e.key, e.value) for e in i.external_data])['length'])
+                                    for i in iterate_initializers(scan_mp.graph) if external_data_helper.uses_external_data(i)]
+                assert len(external_lengths) > 0
+                assert os.path.getsize(scan_model_name + '.data') == sum(external_lengths)
+
+                sess = onnxrt.InferenceSession(scan_model_name)
+                scan_data_output = sess.run([], {'input':data_input, 'seq_len':data_seq_len})
+                assert np.allclose(lstm_data_output, scan_data_output)
+
+    def test_scan_target_ep(self):
+        input_dim = 3
+        hidden_dim = 5
+        layers = 2
+        seq_len = 8
+        batch_size = 2
+        data_input = (np.random.rand(seq_len, batch_size, input_dim) * 2 - 1).astype(np.float32)
+
+        for rnn_type in ['lstm', 'gru', 'rnn']:
+            rnn_model_name = 'test_target_ep_{}.onnx'.format(rnn_type)
+            generate_model(rnn_type, input_dim, hidden_dim, False, layers, rnn_model_name, batch_one=False)
+            # add Y_h (and Y_c for LSTM) to each layer, with Y_h of the last layer as graph output and others unused
+            rnn_mp = onnx.load(rnn_model_name)
+            rnn_nodes = [n for n in rnn_mp.graph.node if n.op_type == rnn_type.upper()]
+            for n in rnn_nodes:
+                n.output.extend([n.output[0] + '_h'] + ([n.output[0] + '_c'] if rnn_type == 'lstm' else []))
+            rnn_mp.graph.output.add().CopyFrom(helper.make_tensor_value_info(rnn_nodes[-1].output[1], onnx.TensorProto.FLOAT, [1, 'b', hidden_dim]))
+            onnx.save(rnn_mp, rnn_model_name)
+            sess = onnxrt.InferenceSession(rnn_model_name)
+            rnn_data_output = sess.run([], {'input':data_input})
+
+            # LSTM/GRU/RNN are kept for cpu, with unused outputs trimmed
+            cpu_model_name = 'test_target_ep_{}_cpu.onnx'.format(rnn_type)
+            subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.model_editor', '--input', rnn_model_name, '--output', cpu_model_name, '--mode', 'to_scan', '--target_ep', 'cpu'], check=True)
+            cpu_mp = onnx.load(cpu_model_name)
+            assert [n.op_type for n in cpu_mp.graph.node] == [n.op_type for n in rnn_mp.graph.node]
+            cpu_rnn_nodes = [n for n in cpu_mp.graph.node if n.op_type == rnn_type.upper()]
+            assert [list(n.output) for n in cpu_rnn_nodes[:-1]] == [[n.output[0]] + [''] * (len(n.output) - 1) for n in rnn_nodes[:-1]]
+            assert list(cpu_rnn_nodes[-1].output[:2]) == list(rnn_nodes[-1].output[:2])
+            assert all([o == '' for o in cpu_rnn_nodes[-1].output[2:]])
+            # shapes are inferred for the outputs that are kept
+            assert all([vi.name for vi in cpu_mp.graph.value_info])
+
+            sess = onnxrt.InferenceSession(cpu_model_name)
+            cpu_data_output = sess.run([], {'input':data_input})
+            assert all([np.allclose(r, c) for r, c in zip(rnn_data_output, cpu_data_output)])
+
+    def test_quantize_scan_gemm(self):
+        input_dim = 32
+        hidden_dim = 32
+        layers = 2
+        seq_len = 8
+        batch_size = 2
+        data_input = (np.random.rand(seq_len, batch_size, input_dim) * 2 - 1).astype(np.float32)
+
+        lstm_model_name = 'test_quantize_gemm_lstm.onnx'
+        scan_model_name = 'test_quantize_gemm_scan.onnx'
+        int8_model_name = 'test_quantize_gemm_int8.onnx'
+        generate_model('lstm', input_dim, hidden_dim, False, layers, lstm_model_name, batch_one=False)
+        subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.model_editor', '--input', lstm_model_name, '--output', scan_model_name, '--mode', 'to_scan'], check=True)
+        sess = onnxrt.InferenceSession(scan_model_name)
+        scan_data_output = sess.run([], {'input':data_input})
+
+        # input projections of Scan are emitted as Gemm in main graph, which are quantized like MatMul
+        scan_mp = onnx.load(scan_model_name)
+        num_gemm = len([n for n in scan_mp.graph.node if n.op_type == 'Gemm'])
+        assert num_gemm == layers
+        subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.model_quantizer', '--input', scan_model_name, '--output', int8_model_name], check=True)
+        int8_mp = onnx.load(int8_model_name)
+        assert [n for n in int8_mp.graph.node if n.op_type == 'Gemm'] == []
+        assert len([n for n in int8_mp.graph.node if n.op_type == 'MatMulInteger']) == num_gemm
+
+        sess = onnxrt.InferenceSession(int8_model_name)
+        int8_data_output = sess.run([], {'input':data_input})
+        assert np.allclose(scan_data_output, int8_data_output, atol=0.1)
+
 
     def test_symbolic_shape_infer(self):
         cwd = os.getcwd()
@@ -181,5 +321,156 @@ class TestNuphar(unittest.TestCase):
             subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.symbolic_shape_infer', '--input', str(filename), '--auto_merge', '--int_max=100000', '--guess_output_rank'], check=True, cwd=cwd)
 
 
+    def test_remove_initializers_from_inputs(self):
+        # old style model of IR version 3, with initializers of main graph and Scan body in graph inputs
+        # tensors are large enough to be saved as external data
+        dim = 512
+        body = helper.make_graph([helper.make_node('Add', ['s', 'sub_w'], ['s_next']), helper.make_node('Add', ['s_next', 'x'], ['y'])], 'body',
+                                 [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, [dim]) for n in ['s', 'x']],
+                                 [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, [dim]) for n in ['s_next', 'y']],
+                                 [numpy_helper.from_array(np.random.rand(dim).astype(np.float32), 'sub_w')])
+        graph = helper.make_graph([helper.make_node('Mul', ['X', 'main_w'], ['X1']),
+                                   helper.make_node('Scan', ['S', 'X1'], ['S_final', 'Y'], body=body, num_scan_inputs=1)], 'main',
+                                  [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, shape) for n, shape in [('S', [dim]), ('X', ['seq', dim]), ('main_w', [dim]), ('sub_w', [dim])]],
+                                  [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, None) for n in ['S_final', 'Y']],
+                                  [numpy_helper.from_array(np.random.rand(dim).astype(np.float32), 'main_w')])
+        mp = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 9)])
+        mp.ir_version = 3
+
+        def expected_model(remain_inputs):
+            expected = onnx.ModelProto()
+            expected.CopyFrom(mp)
+            expected.graph.ClearField('input')
+            expected.graph.input.extend([i for i in mp.graph.input if i.name in ['S', 'X'] + remain_inputs])
+            return expected
+
+        # load model with tensors in external data, which are marked as stored inline afterwards, like tensors that were never external
+        def load_inline_model(model_path):
+            loaded = onnx.load(model_path)
+            for t in list(loaded.graph.initializer) + list(loaded.graph.node[1].attribute[0].g.initializer):
+                t.ClearField('data_location')
+            return loaded
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, 'other'))
+            for input_external_data in [False, True]:
+                for use_external_data in [False, True]:
+                    for remain_inputs in [[], ['main_w'], ['main_w', 'sub_w']]:
+                        for output_name in ['in_place', 'out.onnx', os.path.join('other', 'out.onnx')]:
+                            input_model = os.path.join(tmp_dir, 'in.onnx')
+                            # save a copy, since saving as external data moves tensor data out of the saved model
+                            input_mp = onnx.ModelProto()
+                            input_mp.CopyFrom(mp)
+                            if input_external_data:
+                                # only the main graph initializer is in external data, so outputs could refer to both in.onnx.data and their own
+                                external_data_helper.set_external_data(input_mp.graph.initializer[0], 'in.onnx.data')
+                            onnx.save(input_mp, input_model)
+                            output_model = input_model if output_name == 'in_place' else os.path.join(tmp_dir, output_name)
+                            remove_initializers_from_inputs(input_model, output_model, remain_inputs, use_external_data)
+                            # tensors in external data are loaded, so the result should be the same as editing the inline model
+                            assert load_inline_model(output_model) == expected_model(remain_inputs)
+                            if output_model != input_model and os.path.exists(output_model + '.data'):
+                                # rerunning with the same output should not grow its external data
+                                data_size = os.path.getsize(output_model + '.data')
+                                remove_initializers_from_inputs(input_model, output_model, remain_inputs, use_external_data)
+                                assert os.path.getsize(output_model + '.data') == data_size
+                                assert load_inline_model(output_model) == expected_model(remain_inputs)
+                            for f in os.listdir(tmp_dir):
+                                if os.path.isfile(os.path.join(tmp_dir, f)):
+                                    os.remove(os.path.join(tmp_dir, f))
+
+    def test_remove_initializers_from_inputs_with_external_data(self):
+        # symbolic shape inference reads the Reshape shape from external data, which needs to be found next to the model
+        # instead of the working directory, and tensors should stay in external data after shape inference
+        graph = helper.make_graph([helper.make_node('Reshape', ['X', 'shape'], ['X2']), helper.make_node('MatMul', ['X2', 'W'], ['Y'])], 'main',
+                                  [helper.make_tensor_value_info('X', onnx.TensorProto.FLOAT, ['batch', 2, 3]),
+                                   helper.make_tensor_value_info('shape', onnx.TensorProto.INT64, [2]),
+                                   helper.make_tensor_value_info('W', onnx.TensorProto.FLOAT, [6, 4])],
+                                  [helper.make_tensor_value_info('Y', onnx.TensorProto.FLOAT, None)],
+                                  [numpy_helper.from_array(np.asarray([-1, 6]).astype(np.int64), 'shape'),
+                                   numpy_helper.from_array(np.random.rand(6, 4).astype(np.float32), 'W')])
+        mp = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 9)])
+        mp.ir_version = 3
+        external_data_helper.convert_model_to_external_data(mp, location='in.onnx.data', size_threshold=0)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_model = os.path.join(tmp_dir, 'in.onnx')
+            output_model = os.path.join(tmp_dir, 'out.onnx')
+            onnx.save(mp, input_model)
+            subprocess.run([sys.executable, '-m', 'onnxruntime.nuphar.model_editor', '--input', input_model, '--output', output_model, '--mode', 'remove_initializers_from_inputs'], check=True)
+            out_mp = onnx.load(output_model, load_external_data=False)
+            assert [i.name for i in out_mp.graph.input] == ['X']
+            assert all([external_data_helper.uses_external_data(i) for i in out_mp.graph.initializer])
+            shapes = dict([(vi.name, [d.dim_param or d.dim_value for d in vi.type.tensor_type.shape.dim]) for vi in list(out_mp.graph.value_info) + list(out_mp.graph.output)])
+            assert shapes['X2'] == ['batch', 6] and shapes['Y'] == ['batch', 4]
+
+    def test_infer_shapes_with_cache(self):
+        # Scan body initializer is large enough to be saved as external data
+        dim = 512
+        body = helper.make_graph([helper.make_node('Add', ['s', 'sub_w'], ['s_next']), helper.make_node('Add', ['s_next', 'x'], ['y'])], 'body',
+                                 [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, [dim]) for n in ['s', 'x']],
+                                 [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, [dim]) for n in ['s_next', 'y']],
+                                 [numpy_helper.from_array(np.random.rand(dim).astype(np.float32), 'sub_w')])
+        graph = helper.make_graph([helper.make_node('Scan', ['S', 'X'], ['S_final', 'Y'], body=body, num_scan_inputs=1)], 'main',
+                                  [helper.make_tensor_value_info('S', onnx.TensorProto.FLOAT, [dim]), helper.make_tensor_value_info('X', onnx.TensorProto.FLOAT, ['seq', dim])],
+                                  [helper.make_tensor_value_info(n, onnx.TensorProto.FLOAT, None) for n in ['S_final', 'Y']])
+        mp = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 9)])
+
+        def model_hash(model):
+            h = hashlib.blake2b(digest_size=16)
+            _hash_message(h, model)
+            return h.hexdigest()
+
+        # hash covers tensor data in Scan body, and does not change when the model is serialized and parsed again
+        changed_mp = onnx.ModelProto()
+        changed_mp.CopyFrom(mp)
+        changed_w = changed_mp.graph.node[0].attribute[0].g.initializer[0]
+        changed_w.CopyFrom(numpy_helper.from_array(numpy_helper.to_array(changed_w) + 1, 'sub_w'))
+        assert model_hash(mp) == model_hash(onnx.load_model_from_string(mp.SerializeToString()))
+        assert model_hash(mp) != model_hash(changed_mp)
+
+        def infer(model_path, cache_dir, use_external_data):
+            input_mp = onnx.ModelProto()
+            input_mp.CopyFrom(mp)
+            infer_shapes_with_cache(model_path, cache_dir, input_mp, use_external_data)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            model_path = os.path.join(tmp_dir, 'out.onnx')
+            for use_external_data in [False, True]:
+                cache_count = len(os.listdir(cache_dir)) if os.path.exists(cache_dir) else 0
+                # miss, which runs shape inference and adds the result with its external data to cache
+                infer(model_path, cache_dir, use_external_data)
+                assert len(os.listdir(cache_dir)) == cache_count + (2 if use_external_data else 1)
+                expected = onnx.load(model_path)
+                assert len(expected.graph.value_info) > 0
+                assert os.path.exists(model_path + '.data') == use_external_data
+
+                # hit, which restores the output and its external data from cache, with doc_string marking the cached model
+                cached_model = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+                                if f.endswith('.onnx') and os.path.exists(os.path.join(cache_dir, f + '.data')) == use_external_data][0]
+                cached_mp = onnx.load(cached_model, load_external_data=False)
+                cached_mp.doc_string = 'cached'
+                onnx.save(cached_mp, cached_model)
+                os.remove(model_path)
+                if use_external_data:
+                    os.remove(model_path + '.data')
+                infer(model_path, cache_dir, use_external_data)
+                assert len(os.listdir(cache_dir)) == cache_count + (2 if use_external_data else 1)
+                out_mp = onnx.load(model_path)
+                assert out_mp.doc_string == 'cached'
+                assert out_mp.graph == expected.graph
+
+            # output name and inference options are part of the key
+            cache_count = len(os.listdir(cache_dir))
+            infer(os.path.join(tmp_dir, 'other.onnx'), cache_dir, True)
+            assert len(os.listdir(cache_dir)) == cache_count + 2
+            assert onnx.load(os.path.join(tmp_dir, 'other.onnx')).doc_string == ''
+            with unittest.mock.patch.dict(model_editor._SHAPE_INFER_OPTIONS, {'guess_output_rank':True}):
+                infer(model_path, cache_dir, True)
+            assert len(os.listdir(cache_dir)) == cache_count + 4
+            assert onnx.load(model_path).doc_string == ''
+
+
 if __name__ == '__main__':
     unittest.main()